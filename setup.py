@@ -0,0 +1,31 @@
+import os
+import typing
+
+from setuptools import setup
+
+# experimenter is plain Python. Setting EXPERIMENTER_COMPILE to cython or
+# mypyc builds the same source as an extension module with that compiler
+# instead, which takes the interpreter overhead out of the per-call
+# wrapper. The pure-Python module is used if the variable is unset.
+compile_with = os.environ.get("EXPERIMENTER_COMPILE", "")
+
+ext_modules: typing.List[typing.Any] = []
+if compile_with == "cython":
+    from Cython.Build import cythonize
+    ext_modules = cythonize(["src/experimenter.py"], language_level=3)
+elif compile_with == "mypyc":
+    # Note mypyc builds never free functions decorated with experiment();
+    # see the comment on _flushers in src/experimenter.py
+    from mypyc.build import mypycify
+    ext_modules = mypycify(["src/experimenter.py"])
+elif compile_with:
+    raise SystemExit(f"unknown EXPERIMENTER_COMPILE value {compile_with!r}")
+
+setup(
+    name="experimenter",
+    version="0.1.0",
+    package_dir={"": "src"},
+    py_modules=["experimenter"],
+    ext_modules=ext_modules,
+    python_requires=">=3.8",
+)
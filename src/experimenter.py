@@ -1,17 +1,27 @@
+import atexit
+import sys
+import types
 import typing
 import inspect
+import operator
 import dataclasses
 import sqlite3
+import weakref
 import functools
 
-# Python 3.8 workaound
+# Python 3.8 workaound: dataclasses.Field can't be subscripted at runtime,
+# so the alias only exists for type checkers and is used as a string
 if typing.TYPE_CHECKING:
     DataclassesFieldAny = dataclasses.Field[typing.Any]
+
+# dataclass(slots=True) is only accepted from Python 3.10
+if sys.version_info >= (3, 10):
+    _DATACLASS_SLOTS: typing.Dict[str, bool] = {"slots": True}
 else:
-    DataclassesFieldAny = dataclasses.Field
+    _DATACLASS_SLOTS = {}
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True, **_DATACLASS_SLOTS)
 class ColumnSpec:
     name: str
     type: str
@@ -22,13 +32,21 @@ class ColumnSpec:
         return f"    {self.name} {self.type}{mods}"
 
 
+# PEP 604 unions (`int | None`) have origin types.UnionType, which only
+# exists from Python 3.10
+if sys.version_info >= (3, 10):
+    _UNION_ORIGINS: typing.Tuple[typing.Any, ...] = (typing.Union, types.UnionType)
+else:
+    _UNION_ORIGINS = (typing.Union,)
+
+
 def unwrap_union(
         python_type: typing.Any,
 ) -> typing.Optional[typing.List[typing.Any]]:
-    if getattr(python_type, "__origin__", None) != typing.Union:
+    if typing.get_origin(python_type) not in _UNION_ORIGINS:
         return None
     else:
-        return [arg for arg in python_type.__args__]
+        return list(typing.get_args(python_type))
 
 
 def unwrap_optional(python_type: typing.Any) -> typing.Optional[typing.Any]:
@@ -45,23 +63,24 @@ def unwrap_optional(python_type: typing.Any) -> typing.Optional[typing.Any]:
         return None
 
 
+_SQL_TYPE_MAP: typing.Dict[typing.Any, typing.Tuple[str, str]] = {
+    int: ("INTEGER", "NOT NULL"),
+    float: ("REAL", "NOT NULL"),
+    str: ("TEXT", "NOT NULL"),
+    bytes: ("BLOB", "NOT NULL"),
+}
+
+
+@functools.lru_cache(maxsize=None)
 def python_type_to_sqlite_type(python_type: typing.Any) -> typing.Tuple[str, str]:
     if (optional_type := unwrap_optional(python_type)) is not None:
-        sql_type, mods = python_type_to_sqlite_type(optional_type)
-        return sql_type, ""
-    elif python_type == int:
-        return "INTEGER", "NOT NULL"
-    elif python_type == float:
-        return "REAL", "NOT NULL"
-    elif python_type == str:
-        return "TEXT", "NOT NULL"
-    elif python_type == bytes:
-        return "BLOB", "NOT NULL"
-    assert False
-
-
-def dc_field_to_columnspec(field: DataclassesFieldAny) -> ColumnSpec:
-    sql_type, mods = python_type_to_sqlite_type(field.type)
+        return _SQL_TYPE_MAP[optional_type][0], ""
+    return _SQL_TYPE_MAP[python_type]
+
+
+def dc_field_to_columnspec(field: "DataclassesFieldAny") -> ColumnSpec:
+    field_type: typing.Any = field.type
+    sql_type, mods = python_type_to_sqlite_type(field_type)
     return ColumnSpec(
         name=field.name,
         type=sql_type,
@@ -69,11 +88,35 @@ def dc_field_to_columnspec(field: DataclassesFieldAny) -> ColumnSpec:
     )
 
 
-def dataclass_to_field_specs(x: typing.Any) -> typing.List[ColumnSpec]:
-    return [
+# Field specs by dataclass, held weakly so caching them doesn't keep every
+# return dataclass alive
+_field_specs: "weakref.WeakKeyDictionary[typing.Any, typing.Tuple[ColumnSpec, ...]]" = weakref.WeakKeyDictionary()
+
+
+def dataclass_to_field_specs_uncached(x: typing.Any) -> typing.Tuple[ColumnSpec, ...]:
+    return tuple(
         dc_field_to_columnspec(field)
         for field in dataclasses.fields(x)
-    ]
+    )
+
+
+def dataclass_to_field_specs_cached(x: typing.Any) -> typing.Tuple[ColumnSpec, ...]:
+    try:
+        specs = _field_specs.get(x)
+    except TypeError:
+        # Not weakly referenceable (e.g. a dataclass instance), so can't be
+        # cached
+        return dataclass_to_field_specs_uncached(x)
+
+    if specs is None:
+        specs = _field_specs[x] = dataclass_to_field_specs_uncached(x)
+    return specs
+
+
+def dataclass_to_field_specs(x: typing.Any) -> typing.List[ColumnSpec]:
+    # The cache hands back the same tuple each time, so give each caller
+    # its own list
+    return list(dataclass_to_field_specs_cached(x))
 
 
 def parameter_to_columnspec(parameter: inspect.Parameter) -> ColumnSpec:
@@ -85,29 +128,43 @@ def parameter_to_columnspec(parameter: inspect.Parameter) -> ColumnSpec:
     )
     
 
-def function_args_to_columns(function: typing.Callable[..., typing.Any]) -> typing.List[ColumnSpec]:
-    args = inspect.signature(function).parameters.values()
+def signature_args_to_columns(signature: inspect.Signature) -> typing.List[ColumnSpec]:
     return [
         parameter_to_columnspec(parameter)
-        for parameter in args
+        for parameter in signature.parameters.values()
     ]
 
 
+def function_args_to_columns(function: typing.Callable[..., typing.Any]) -> typing.List[ColumnSpec]:
+    return signature_args_to_columns(inspect.signature(function))
+
+
 def function_to_columns(function: typing.Callable[..., typing.Any]) -> typing.Tuple[typing.List[ColumnSpec], typing.List[ColumnSpec]]:
-    arg_columns = function_args_to_columns(function)
-    ret_columns = dataclass_to_field_specs(inspect.signature(function).return_annotation)
+    signature = inspect.signature(function)
+    arg_columns = signature_args_to_columns(signature)
+    ret_columns = dataclass_to_field_specs(signature.return_annotation)
     return arg_columns, ret_columns
 
 
 def function_to_create_table_sql(table_name: str, function: typing.Callable[..., typing.Any]) -> str:
     arg_cols, ret_cols = function_to_columns(function)
-    cols = arg_cols + ret_cols
-    cols_sql_lines = [col.to_create_table_sql_line() for col in cols]
-    cols_sql = ",\n".join(cols_sql_lines)
+    return columns_to_create_table_sql(table_name, arg_cols, ret_cols)
+
+
+def columns_to_create_table_sql(
+        table_name: str,
+        arg_cols: typing.List[ColumnSpec],
+        ret_cols: typing.List[ColumnSpec],
+) -> str:
+    # Same lines as ColumnSpec.to_create_table_sql_line, inlined
+    cols_sql = ",\n".join(
+        f"    {col.name} {col.type} {col.mods}" if col.mods else f"    {col.name} {col.type}"
+        for col in arg_cols + ret_cols
+    )
     return f"CREATE TABLE {table_name}(\n{cols_sql}\n)"
     
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True, **_DATACLASS_SLOTS)
 class InsertSQLInfo:
     sql_text: str
     arguments: typing.List[str]
@@ -116,27 +173,258 @@ class InsertSQLInfo:
 
 def function_to_insert_sql(table_name: str, function: typing.Callable[..., typing.Any]) -> InsertSQLInfo:
     arg_cols, ret_cols = function_to_columns(function)
-    cols = arg_cols + ret_cols
-    col_names = [col.name for col in cols]
+    return columns_to_insert_sql(table_name, arg_cols, ret_cols)
+
+
+def columns_to_insert_sql(
+        table_name: str,
+        arg_cols: typing.List[ColumnSpec],
+        ret_cols: typing.List[ColumnSpec],
+) -> InsertSQLInfo:
+    arguments = [col.name for col in arg_cols]
+    return_fields = [col.name for col in ret_cols]
+    col_names = arguments + return_fields
     col_names_str = ", ".join(col_names)
-    question_marks = ", ".join(["?"] * len(cols))
+    question_marks = ", ".join("?" * len(col_names))
 
     sql_text = f"INSERT INTO {table_name}({col_names_str})\nVALUES ({question_marks})"
     return InsertSQLInfo(
         sql_text=sql_text,
-        arguments=[col.name for col in arg_cols],
-        return_fields=[col.name for col in ret_cols],
+        arguments=arguments,
+        return_fields=return_fields,
     )
 
 
+# Opens a database tuned for experiment logging: WAL journaling and
+# synchronous=NORMAL mean an insert doesn't wait on an fsync, at the cost
+# of possibly losing the last few rows if the machine (not the process)
+# dies. That's the right trade for do_experiment/experiment, which insert
+# far more often than anything reads. In-memory databases have nothing to
+# sync, so they are opened as-is. The larger statement cache keeps every
+# experiment's prepared INSERT around when many tables share a connection.
+def open_db(path: str) -> sqlite3.Cursor:
+    con = sqlite3.connect(path, cached_statements=1024)
+    if path != ":memory:":
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.execute("PRAGMA temp_store=MEMORY")
+        con.execute("PRAGMA cache_size=-65536")
+    return con.cursor()
+
+
 def maybe_create_table(db: sqlite3.Cursor, table_name: str, create_table_sql: str) -> None:
-    check_rows = list(db.execute(
-        "SELECT name FROM sqlite_master WHERE type='table' AND name=?",
-        (table_name,)
-    ))
-    assert check_rows == [] or check_rows == [(table_name,)]
-    if check_rows == []:
-        db.execute(create_table_sql)
+    # IF NOT EXISTS has SQLite do the existence check as part of the same
+    # statement, rather than us querying sqlite_master first
+    if not create_table_sql.startswith("CREATE TABLE IF NOT EXISTS "):
+        create_table_sql = create_table_sql.replace("CREATE TABLE ", "CREATE TABLE IF NOT EXISTS ", 1)
+    db.execute(create_table_sql)
+
+
+# Tables each cursor is known to have, so that maybe_create_table only needs
+# to run on the first insert into a table rather than on every one. Keyed
+# weakly on the cursor itself rather than on its id() so a closed and
+# collected database can't have its entries inherited by a new one.
+_ensured_tables: "weakref.WeakKeyDictionary[sqlite3.Cursor, typing.Set[str]]" = weakref.WeakKeyDictionary()
+
+
+def ensure_table(db: sqlite3.Cursor, table_name: str, create_table_sql: str) -> None:
+    ensured = _ensured_tables.get(db)
+    if ensured is None:
+        ensured = _ensured_tables[db] = set()
+    if table_name not in ensured:
+        maybe_create_table(db, table_name, create_table_sql)
+        ensured.add(table_name)
+
+
+ReturnExtractor = typing.Callable[[typing.Any], typing.Tuple[typing.Any, ...]]
+RowBuilder = typing.Callable[
+    [typing.Tuple[typing.Any, ...], typing.Dict[str, typing.Any], typing.Any],
+    typing.Tuple[typing.Any, ...],
+]
+
+
+def parameter_to_extractor_expr(index: int, parameter: inspect.Parameter) -> str:
+    name = repr(parameter.name)
+    has_default = parameter.default is not inspect.Parameter.empty
+    if parameter.kind is inspect.Parameter.KEYWORD_ONLY:
+        from_args = None
+    elif parameter.kind in (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD):
+        from_args = f"args[{index}]"
+    else:
+        raise ValueError(f"variadic parameter {parameter.name} is not supported")
+
+    if parameter.kind is inspect.Parameter.POSITIONAL_ONLY:
+        from_kwargs = f"defaults[{name}]" if has_default else None
+    elif has_default:
+        from_kwargs = f"kwargs.get({name}, defaults[{name}])"
+    else:
+        from_kwargs = f"kwargs[{name}]"
+
+    if from_args is None:
+        assert from_kwargs is not None
+        return from_kwargs
+    elif from_kwargs is None:
+        return from_args
+    else:
+        return f"{from_args} if nargs > {index} else {from_kwargs}"
+
+
+def function_to_extractor_exprs(
+        function: typing.Callable[..., typing.Any],
+) -> typing.Tuple[typing.List[str], typing.Dict[str, typing.Any]]:
+    parameters = inspect.signature(function).parameters.values()
+    exprs = [
+        parameter_to_extractor_expr(index, parameter)
+        for index, parameter in enumerate(parameters)
+    ]
+    defaults = {
+        parameter.name: parameter.default
+        for parameter in parameters
+        if parameter.default is not inspect.Parameter.empty
+    }
+    return exprs, defaults
+
+
+def compile_tuple_builder(
+        params: str,
+        exprs: typing.List[str],
+        defaults: typing.Dict[str, typing.Any],
+) -> typing.Callable[..., typing.Tuple[typing.Any, ...]]:
+    source = (
+        f"def build({params}):\n"
+        "    nargs = len(args)\n"
+        f"    return ({''.join(expr + ', ' for expr in exprs)})\n"
+    )
+    namespace: typing.Dict[str, typing.Any] = {"defaults": defaults}
+    exec(source, namespace)
+    return typing.cast(typing.Callable[..., typing.Tuple[typing.Any, ...]], namespace["build"])
+
+
+def make_return_extractor(return_fields: typing.List[str]) -> ReturnExtractor:
+    # attrgetter fetches every field in one call, but hands back a bare
+    # value rather than a 1-tuple when there's only one
+    if not return_fields:
+        return lambda result: ()
+    elif len(return_fields) == 1:
+        get_field = operator.attrgetter(return_fields[0])
+        return lambda result: (get_field(result),)
+    else:
+        return operator.attrgetter(*return_fields)
+
+
+def make_row_builder(
+        function: typing.Callable[..., typing.Any],
+        return_fields: typing.List[str],
+) -> RowBuilder:
+    # Generates straight-line code that builds a whole row in one tuple
+    # display: each argument pulled out of the (args, kwargs) the call was
+    # made with, in parameter order, then the return fields. This is what
+    # inspect.getcallargs does, minus walking the signature each call.
+    exprs, defaults = function_to_extractor_exprs(function)
+    exprs += [f"result.{field_name}" for field_name in return_fields]
+    return compile_tuple_builder("args, kwargs, result", exprs, defaults)
+
+
+def args_are_row_prefix(function: typing.Callable[..., typing.Any]) -> bool:
+    # True if any call without keyword arguments must pass every argument
+    # positionally, in which case args is already the front of the row
+    return all(
+        parameter.kind in (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD)
+        and parameter.default is inspect.Parameter.empty
+        for parameter in inspect.signature(function).parameters.values()
+    )
+
+
+@dataclasses.dataclass(frozen=True, **_DATACLASS_SLOTS)
+class CompiledExperiment:
+    create_table_sql: str
+    insert_info: InsertSQLInfo
+    extract_returns: ReturnExtractor
+    make_row: RowBuilder
+    args_are_row_prefix: bool
+
+
+# Compiled experiments by function, then by table name and whether it was
+# bound. Keyed weakly on the function, like _ensured_tables, so that caching
+# it doesn't keep it alive. Bound methods are a new object on every
+# attribute access, so they're cached under their underlying function;
+# their signature has no self, hence the separate entry.
+_compiled_experiments: "weakref.WeakKeyDictionary[typing.Callable[..., typing.Any], typing.Dict[typing.Tuple[str, bool], CompiledExperiment]]" = weakref.WeakKeyDictionary()
+
+
+def compile_experiment(
+        function: typing.Callable[..., typing.Any],
+        table_name: str,
+) -> CompiledExperiment:
+    # Everything here depends only on the function and table, so compute
+    # it once rather than re-reflecting over the signature on every call
+    if isinstance(function, types.MethodType):
+        key_function: typing.Callable[..., typing.Any] = function.__func__
+        is_bound = True
+    else:
+        key_function = function
+        is_bound = False
+
+    try:
+        by_table = _compiled_experiments.get(key_function)
+    except TypeError:
+        # Not weakly referenceable, so can't be cached
+        return compile_experiment_uncached(function, table_name)
+    if by_table is None:
+        by_table = _compiled_experiments[key_function] = {}
+
+    key = (table_name, is_bound)
+    compiled = by_table.get(key)
+    if compiled is None:
+        compiled = by_table[key] = compile_experiment_uncached(function, table_name)
+    return compiled
+
+
+def compile_experiment_uncached(
+        function: typing.Callable[..., typing.Any],
+        table_name: str,
+) -> CompiledExperiment:
+    arg_cols, ret_cols = function_to_columns(function)
+    insert_info = columns_to_insert_sql(table_name, arg_cols, ret_cols)
+    return CompiledExperiment(
+        create_table_sql=columns_to_create_table_sql(table_name, arg_cols, ret_cols),
+        insert_info=insert_info,
+        extract_returns=make_return_extractor(insert_info.return_fields),
+        make_row=make_row_builder(function, insert_info.return_fields),
+        args_are_row_prefix=args_are_row_prefix(function),
+    )
+
+
+def insert_rows(
+        db: sqlite3.Cursor,
+        insert_sql: str,
+        rows: typing.Sequence[typing.Sequence[typing.Any]],
+) -> None:
+    # If the caller already has a transaction open the rows just join it;
+    # otherwise give the whole batch one transaction instead of one each
+    if db.connection.in_transaction:
+        db.executemany(insert_sql, rows)
+        return
+
+    db.execute("BEGIN")
+    try:
+        db.executemany(insert_sql, rows)
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+
+# do_experiment's own cursor for each cursor it's called with, so inserting
+# never resets a query the caller is part way through reading from theirs
+_private_cursors: "weakref.WeakKeyDictionary[sqlite3.Cursor, sqlite3.Cursor]" = weakref.WeakKeyDictionary()
+
+
+def private_cursor(db: sqlite3.Cursor) -> sqlite3.Cursor:
+    cursor = _private_cursors.get(db)
+    if cursor is None:
+        cursor = _private_cursors[db] = db.connection.cursor()
+    return cursor
 
 
 RetT = typing.TypeVar('RetT')
@@ -147,38 +435,120 @@ def do_experiment(
         *args: typing.Any,
         **kwargs: typing.Any,
 ) -> RetT:
-    bound_args = inspect.getcallargs(func, *args, **kwargs)
+    compiled = compile_experiment(func, table_name)
     result = func(*args, **kwargs)
+    cursor = private_cursor(db)
 
     #
-    create_table_sql = function_to_create_table_sql(table_name, func)
-    maybe_create_table(db, table_name, create_table_sql)
+    ensure_table(cursor, table_name, compiled.create_table_sql)
 
     #
-    insert_info = function_to_insert_sql(table_name, func)
-    arg_values = [
-        bound_args[arg_name]
-        for arg_name in insert_info.arguments
-    ]
-    ret_values = [
-        getattr(result, field_name)
-        for field_name in insert_info.return_fields
-    ]
-    db.execute(insert_info.sql_text, arg_values+ret_values)
+    row = compiled.make_row(args, kwargs, result)
+    cursor.execute(compiled.insert_info.sql_text, row)
 
     return result
 
 
+# The flush() of every experiment with a buffer_size, and the connection it
+# writes to. Held weakly so registering doesn't keep a decorated function,
+# or its database, alive. That only holds for the pure-Python module: when
+# built with mypyc, the nested functions experiment() creates are never
+# freed (mypyc doesn't collect closures that refer to each other, nor
+# release the attributes functools.wraps sets on them), so each decorated
+# function's cursor and buffer live until exit.
+_flushers: "weakref.WeakKeyDictionary[typing.Callable[[], None], sqlite3.Connection]" = weakref.WeakKeyDictionary()
+
+
+def connection_is_open(connection: sqlite3.Connection) -> bool:
+    try:
+        connection.total_changes
+    except sqlite3.ProgrammingError:
+        return False
+    return True
+
+
+# Writes out the rows buffered by every experiment with a buffer_size.
+# Experiments whose connection has already been closed are skipped, and one
+# experiment failing doesn't stop the others from being flushed; the first
+# failure is re-raised once they all have been tried.
+def flush_all() -> None:
+    errors: typing.List[Exception] = []
+    for flush, connection in list(_flushers.items()):
+        if not connection_is_open(connection):
+            continue
+        try:
+            flush()
+        except Exception as e:
+            errors.append(e)
+    if errors:
+        raise errors[0]
+
+
+atexit.register(flush_all)
+
+
 # Thanks to https://stackoverflow.com/a/65613529 for getting the types
 # of 'wrapped' and the 'cast' call correct
 FuncT = typing.TypeVar('FuncT', bound=typing.Callable[..., typing.Any]) 
 def experiment(
         table_name: str,
         db: sqlite3.Cursor,
+        buffer_size: int = 1,
 ) -> typing.Callable[[FuncT], FuncT]:
+    # With buffer_size > 1, rows are held in memory and inserted in batches
+    # of that many, each batch in a single transaction. Rows still pending
+    # can be written with the decorated function's flush() or with
+    # flush_all(), which also runs at interpreter exit.
     def decorator(func: FuncT) -> FuncT:
+        # Everything that depends only on func is worked out here, once,
+        # so that a call only has to run func and insert its row
+        compiled = compile_experiment(func, table_name)
+        create_table_sql = compiled.create_table_sql
+        insert_sql = compiled.insert_info.sql_text
+        make_row = compiled.make_row
+        extract_returns = compiled.extract_returns
+        args_are_prefix = compiled.args_are_row_prefix
+        # Our own cursor, so inserting never resets a query the caller is
+        # part way through reading from theirs
+        cursor = db.connection.cursor()
+        table_ensured = False
+        pending: typing.List[typing.Tuple[typing.Any, ...]] = []
+
+        def ensure() -> None:
+            nonlocal table_ensured
+            maybe_create_table(cursor, table_name, create_table_sql)
+            table_ensured = True
+
+        def flush() -> None:
+            if not pending:
+                return
+            # Take the batch out first, so a batch that fails to insert is
+            # reported once and dropped rather than retried on every call
+            rows = pending[:]
+            pending.clear()
+            if not table_ensured:
+                ensure()
+            insert_rows(cursor, insert_sql, rows)
+
         @functools.wraps(func)
         def wrapped(*args: typing.Any, **kwargs: typing.Any) -> typing.Any:
-            return do_experiment(func, table_name, db, *args, **kwargs)
+            result = func(*args, **kwargs)
+            if args_are_prefix and not kwargs:
+                row = args + extract_returns(result)
+            else:
+                row = make_row(args, kwargs, result)
+            if buffer_size <= 1:
+                if not table_ensured:
+                    ensure()
+                cursor.execute(insert_sql, row)
+            else:
+                pending.append(row)
+                if len(pending) >= buffer_size:
+                    flush()
+            return result
+
+        if buffer_size > 1:
+            _flushers[flush] = db.connection
+        wrapped.flush = flush  # type: ignore[attr-defined]
         return typing.cast(FuncT, wrapped)
     return decorator
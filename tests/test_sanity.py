@@ -1,10 +1,20 @@
 import pytest
+import gc
+import sys
+import types
+import weakref
 import typing
 import experimenter
 import sqlite3
+import pathlib
 from dataclasses import dataclass
 from contextlib import contextmanager
 
+# Whether the module under test was compiled by mypyc, which turns its
+# functions into builtins (Cython builds have their own function type)
+IS_MYPYC_BUILD = isinstance(experimenter.flush_all, types.BuiltinFunctionType)
+
+
 @contextmanager
 def database_cursor() -> typing.Iterator[sqlite3.Cursor]:
     con = sqlite3.connect(':memory:')
@@ -56,6 +66,22 @@ def test_optional_becomes_nullable() -> None:
     assert fields == expected_fields
 
 
+@pytest.mark.skipif(sys.version_info < (3, 10), reason="PEP 604 unions need Python 3.10")
+def test_pep604_optional_becomes_nullable() -> None:
+    @dataclass
+    class LotsOfColumns:
+        maybe_int: int | None
+        maybe_bytes: None | bytes
+
+    expected_fields = [
+        experimenter.ColumnSpec(name="maybe_int",   type="INTEGER", mods=""),
+        experimenter.ColumnSpec(name="maybe_bytes", type="BLOB",    mods=""),
+    ]
+
+    fields = experimenter.dataclass_to_field_specs(LotsOfColumns)
+    assert fields == expected_fields
+
+
 def test_function_with_no_params() -> None:
     def stupid() -> None: pass
 
@@ -140,6 +166,24 @@ VALUES (?, ?, ?, ?)"""
     assert ["x", "y"] == insert_info.return_fields
 
 
+def test_open_db_uses_wal(tmp_path: pathlib.Path) -> None:
+    db = experimenter.open_db(str(tmp_path / "experiments.db"))
+    try:
+        assert list(db.execute("PRAGMA journal_mode")) == [("wal",)]
+        assert list(db.execute("PRAGMA synchronous")) == [(1,)]
+    finally:
+        db.connection.close()
+
+
+def test_open_db_leaves_memory_alone() -> None:
+    db = experimenter.open_db(":memory:")
+    try:
+        assert list(db.execute("PRAGMA journal_mode")) == [("memory",)]
+        assert list(db.execute("PRAGMA synchronous")) == [(2,)]
+    finally:
+        db.connection.close()
+
+
 def does_test_table_exist(db: sqlite3.Cursor) -> bool:
     matches = list(db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='test'"))
     assert matches == [] or matches == [("test",)]
@@ -188,3 +232,304 @@ def test_inserter() -> None:
             (12, 5, 2, '2'),
             (20, 7, 2, '6'),
         ]
+
+
+def test_inserter_with_keyword_and_default_arguments() -> None:
+    @dataclass
+    class Return:
+        total: int
+
+    with database_cursor() as db:
+        @experimenter.experiment(table_name="test", db=db)
+        def add(a: int, b: int = 10, *, c: int = 100) -> Return:
+            return Return(total=a + b + c)
+
+        add(1)
+        add(1, c=3)
+        add(b=2, a=1)
+        inserted_rows = list(db.execute("SELECT * FROM test"))
+        assert inserted_rows == [
+            (1, 10, 100, 111),
+            (1, 10, 3, 14),
+            (1, 2, 100, 103),
+        ]
+
+
+def test_return_extractor_always_gives_tuple() -> None:
+    @dataclass
+    class Return:
+        x: int
+        y: str
+
+    result = Return(x=1, y="one")
+    assert experimenter.make_return_extractor([])(result) == ()
+    assert experimenter.make_return_extractor(["y"])(result) == ("one",)
+    assert experimenter.make_return_extractor(["x", "y"])(result) == (1, "one")
+
+
+def test_buffered_inserter() -> None:
+    @dataclass
+    class Return:
+        doubled: int
+
+    with database_cursor() as db:
+        @experimenter.experiment(table_name="test", db=db, buffer_size=2)
+        def double(a: int) -> Return:
+            return Return(doubled=a*2)
+
+        double(1)
+        assert not does_test_table_exist(db)
+
+        double(2)
+        double(3)
+        inserted_rows = list(db.execute("SELECT * FROM test"))
+        assert inserted_rows == [
+            (1, 2),
+            (2, 4),
+        ]
+        assert not db.connection.in_transaction
+
+        double.flush()  # type: ignore[attr-defined]
+        inserted_rows = list(db.execute("SELECT * FROM test"))
+        assert inserted_rows == [
+            (1, 2),
+            (2, 4),
+            (3, 6),
+        ]
+
+        double(4)
+        experimenter.flush_all()
+        inserted_rows = list(db.execute("SELECT * FROM test"))
+        assert inserted_rows[-1] == (4, 8)
+
+
+def test_inserter_checks_for_table_once() -> None:
+    @dataclass
+    class Return:
+        doubled: int
+
+    with database_cursor() as db:
+        statements: typing.List[str] = []
+        db.connection.set_trace_callback(statements.append)
+
+        @experimenter.experiment(table_name="test", db=db)
+        def double(a: int) -> Return:
+            return Return(doubled=a*2)
+
+        double(1)
+        double(2)
+        double(3)
+        assert len([sql for sql in statements if "CREATE TABLE" in sql]) == 1
+        assert len([sql for sql in statements if "sqlite_master" in sql]) == 0
+        assert list(db.execute("SELECT * FROM test")) == [(1, 2), (2, 4), (3, 6)]
+
+
+def test_cached_field_specs_are_not_shared() -> None:
+    @dataclass
+    class Return:
+        x: int
+
+    fields = experimenter.dataclass_to_field_specs(Return)
+    fields.append(experimenter.ColumnSpec(name="y", type="TEXT", mods=""))
+
+    assert experimenter.dataclass_to_field_specs(Return) == [
+        experimenter.ColumnSpec(name="x", type="INTEGER", mods="NOT NULL"),
+    ]
+
+
+def test_row_builder() -> None:
+    @dataclass
+    class Return:
+        x: int
+        y: str
+
+    def stupid(a: int, /, b: int, c: int = 3, *, d: int, e: int = 5) -> Return:
+        return Return(x=a, y="")
+
+    result = Return(x=6, y="seven")
+    make_row = experimenter.make_row_builder(stupid, ["x", "y"])
+    assert make_row((1, 2), {"d": 4}, result) == (1, 2, 3, 4, 5, 6, "seven")
+    assert make_row((1,), {"b": 2, "c": 30, "d": 4, "e": 50}, result) == (1, 2, 30, 4, 50, 6, "seven")
+
+
+def test_args_are_row_prefix() -> None:
+    def positional(a: int, b: int, /, c: int) -> None: pass
+    def defaulted(a: int, b: int = 2) -> None: pass
+    def keyword_only(a: int, *, b: int) -> None: pass
+
+    assert experimenter.args_are_row_prefix(positional)
+    assert not experimenter.args_are_row_prefix(defaulted)
+    assert not experimenter.args_are_row_prefix(keyword_only)
+
+
+def test_do_experiment() -> None:
+    @dataclass
+    class Return:
+        doubled: int
+
+    def double(a: int) -> Return:
+        return Return(doubled=a*2)
+
+    with database_cursor() as db:
+        result = experimenter.do_experiment(double, "test", db, 4)
+        assert result == Return(doubled=8)
+        experimenter.do_experiment(double, "test", db, a=5)
+        inserted_rows = list(db.execute("SELECT * FROM test"))
+        assert inserted_rows == [
+            (4, 8),
+            (5, 10),
+        ]
+
+
+def test_inserter_does_not_disturb_callers_cursor() -> None:
+    @dataclass
+    class Return:
+        doubled: int
+
+    with database_cursor() as db:
+        db.execute("CREATE TABLE inputs (a INTEGER NOT NULL)")
+        db.executemany("INSERT INTO inputs VALUES (?)", [(1,), (2,), (3,)])
+
+        @experimenter.experiment(table_name="test", db=db)
+        def double(a: int) -> Return:
+            return Return(doubled=a*2)
+
+        for (a,) in db.execute("SELECT a FROM inputs ORDER BY a"):
+            double(a)
+
+        inserted_rows = list(db.execute("SELECT * FROM test"))
+        assert inserted_rows == [
+            (1, 2),
+            (2, 4),
+            (3, 6),
+        ]
+
+
+def test_buffered_inserter_drops_failed_batch() -> None:
+    @dataclass
+    class Return:
+        doubled: int
+
+    with database_cursor() as db:
+        @experimenter.experiment(table_name="test", db=db, buffer_size=2)
+        def double(a: typing.Optional[int]) -> Return:
+            return Return(doubled=0 if a is None else a*2)
+
+        db.execute("CREATE TABLE test (a INTEGER NOT NULL, doubled INTEGER NOT NULL)")
+        double(None)
+        with pytest.raises(sqlite3.IntegrityError):
+            double(1)
+
+        double(2)
+        double(3)
+        inserted_rows = list(db.execute("SELECT * FROM test"))
+        assert inserted_rows == [
+            (2, 4),
+            (3, 6),
+        ]
+
+
+def test_flush_all_skips_closed_databases() -> None:
+    @dataclass
+    class Return:
+        doubled: int
+
+    with database_cursor() as closed_db, database_cursor() as db:
+        @experimenter.experiment(table_name="test", db=closed_db, buffer_size=2)
+        def double_closed(a: int) -> Return:
+            return Return(doubled=a*2)
+
+        @experimenter.experiment(table_name="test", db=db, buffer_size=2)
+        def double(a: int) -> Return:
+            return Return(doubled=a*2)
+
+        double_closed(1)
+        double(1)
+        closed_db.connection.close()
+
+        experimenter.flush_all()
+        assert list(db.execute("SELECT * FROM test")) == [(1, 2)]
+
+
+# mypyc never frees the closures experiment() creates; see _flushers
+@pytest.mark.skipif(IS_MYPYC_BUILD, reason="mypyc builds keep decorated functions alive")
+def test_flush_all_does_not_keep_experiments_alive() -> None:
+    @dataclass
+    class Return:
+        doubled: int
+
+    with database_cursor() as db:
+        @experimenter.experiment(table_name="test", db=db, buffer_size=2)
+        def double(a: int) -> Return:
+            return Return(doubled=a*2)
+
+        flush_ref = weakref.ref(double.flush)  # type: ignore[attr-defined]
+        del double
+        gc.collect()
+        assert flush_ref() is None
+
+
+def test_do_experiment_does_not_keep_function_alive() -> None:
+    @dataclass
+    class Return:
+        doubled: int
+
+    def double(a: int) -> Return:
+        return Return(doubled=a*2)
+
+    with database_cursor() as db:
+        experimenter.do_experiment(double, "test", db, 4)
+        ref = weakref.ref(double)
+        del double
+        gc.collect()
+        assert ref() is None
+
+
+def test_field_specs_do_not_keep_dataclass_alive() -> None:
+    @dataclass
+    class Return:
+        x: int
+
+    experimenter.dataclass_to_field_specs(Return)
+    ref = weakref.ref(Return)
+    del Return
+    gc.collect()
+    assert ref() is None
+
+
+def test_do_experiment_does_not_disturb_callers_cursor() -> None:
+    @dataclass
+    class Return:
+        doubled: int
+
+    def double(a: int) -> Return:
+        return Return(doubled=a*2)
+
+    with database_cursor() as db:
+        db.execute("CREATE TABLE inputs (a INTEGER NOT NULL)")
+        db.executemany("INSERT INTO inputs VALUES (?)", [(1,), (2,), (3,)])
+
+        for (a,) in db.execute("SELECT a FROM inputs ORDER BY a"):
+            experimenter.do_experiment(double, "test", db, a)
+
+        inserted_rows = list(db.execute("SELECT * FROM test"))
+        assert inserted_rows == [
+            (1, 2),
+            (2, 4),
+            (3, 6),
+        ]
+
+
+def test_bound_method_compiles_once() -> None:
+    @dataclass
+    class Return:
+        doubled: int
+
+    class Doubler:
+        def double(self, a: int) -> Return:
+            return Return(doubled=a*2)
+
+    first = experimenter.compile_experiment(Doubler().double, "test")
+    second = experimenter.compile_experiment(Doubler().double, "test")
+    assert first is second
+    assert first.insert_info.arguments == ["a"]